@@ -306,6 +306,14 @@ class ComfyUI:
     def cleanup(self, directories):
         self.clear_queue()
         for directory in directories:
-            if os.path.exists(directory):
-                shutil.rmtree(directory)
-            os.makedirs(directory)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+                continue
+
+            # Empty the directory but keep it, to avoid rmdir/mkdir churn
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path)
+                    else:
+                        os.unlink(entry.path)
@@ -1,18 +1,102 @@
+import errno
+import importlib.util
 import os
+import re
 import urllib.parse
 import shutil
 import time
+import socket
 import subprocess
 import tarfile
-from huggingface_hub import hf_hub_download
+import tempfile
+import threading
+import requests
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-HF_TEMP_DIR = "TEMP_HF"
 COMFYUI_LORA_DIR = "ComfyUI/models/loras"
+# Persistent HuggingFace cache, so a LoRA already fetched by a previous
+# container is linked into place instead of downloaded again
+HF_CACHE_DIR = os.environ.get("HF_HUB_CACHE", "/src/hf-cache")
+LORA_PARALLEL_WORKERS = int(os.environ.get("LORA_PARALLEL_WORKERS", "8"))
+# pget defaults to 4 x GOMAXPROCS connections, so only override when asked
+PGET_CONCURRENCY = os.environ.get("PGET_CONCURRENCY")
+RANGE_CONNECTIONS = int(os.environ.get("RANGE_CONNECTIONS", "8"))
+REPLICATE_LORA_MEMBER = "output/flux_train_replicate/lora.safetensors"
+DOWNLOAD_TIMEOUT = 600
+HF_URL_PATTERN = re.compile(
+    r"^https://huggingface\.co/([^/]+)/([^/]+)/[^/]+/([^/]+)/(.+)$"
+)
+
+# LoRAs are never deleted once downloaded, so remember which paths exist
+# to avoid repeating the same stat/mkdir calls on every prediction
+_KNOWN_PATHS: set[str] = set()
+_MADE_DIRS: set[str] = set()
+
+
+def _exists(path: str) -> bool:
+    if path in _KNOWN_PATHS:
+        return True
+    if os.path.exists(path):
+        _KNOWN_PATHS.add(path)
+        return True
+    return False
+
+
+def _ensure_dir(path: str):
+    if path not in _MADE_DIRS:
+        os.makedirs(path, exist_ok=True)
+        _MADE_DIRS.add(path)
+
+
+def _abort_response(response):
+    # Shut the socket down so a thread blocked reading it wakes immediately
+    sock = getattr(getattr(response.raw, "connection", None), "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+@contextmanager
+def _atomic_write(dest_path: str):
+    # Write to a temp file beside dest_path and only move it into place once
+    # complete, so a failed download never leaves a partial LoRA behind
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(dest_path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            yield f
+        os.replace(temp_path, dest_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
 
 
 class DownloadExternalLora:
     def __init__(self):
-        os.environ["HF_HUB_ENABLE_HF_TRANSFER"] = "1"
+        # huggingface_hub is imported lazily, so it reads this flag and would
+        # refuse to download at all if hf_transfer were missing
+        if importlib.util.find_spec("hf_transfer") is not None:
+            os.environ["HF_HUB_ENABLE_HF_TRANSFER"] = "1"
+        # Only read by multi-file fetches such as snapshot_download. The
+        # single-file hf_hub_download used below ignores these flags.
+        os.environ["HF_ENABLE_PARALLEL_DOWNLOADING"] = "1"
+        os.environ.setdefault("HF_PARALLEL_DOWNLOADING_WORKERS", "8")
+
+        # One connection pool for all Civitai and Replicate fetches, so
+        # repeat downloads from the same host skip the TCP/TLS handshake.
+        # Sized so every range of every parallel download gets a connection.
+        self.session = requests.Session()
+        self.session.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=16,
+                pool_maxsize=LORA_PARALLEL_WORKERS * RANGE_CONNECTIONS,
+                max_retries=3,
+            ),
+        )
 
     def download(self, url: str) -> str:
         if url.startswith("https://huggingface.co"):
@@ -26,6 +110,25 @@ class DownloadExternalLora:
                 "URL must be from 'huggingface.co', 'civitai.com', or 'replicate.delivery'"
             )
 
+    def download_all(self, urls: list[str]) -> list[str]:
+        filenames = [None] * len(urls)
+        # Not used as a context manager, since __exit__ would wait for every
+        # remaining download before a failure could be raised
+        executor = ThreadPoolExecutor(max_workers=LORA_PARALLEL_WORKERS)
+        futures = {
+            executor.submit(self.download, url): index
+            for index, url in enumerate(urls)
+        }
+        try:
+            for future in as_completed(futures):
+                filenames[futures[future]] = future.result()
+        except BaseException:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+        executor.shutdown()
+        return filenames
+
     def download_from_huggingface(self, url: str) -> str:
         repo_id, revision, filename_and_path, original_filename = (
             self.extract_parts_from_huggingface_url(url)
@@ -38,19 +141,32 @@ class DownloadExternalLora:
         filename = f"{repo_id.replace('/', '_')}_{original_filename}"
         dest_path = os.path.join(COMFYUI_LORA_DIR, filename)
 
-        if os.path.exists(dest_path):
+        if _exists(dest_path):
             print(f"File {filename} already exists. Skipping download.")
             return filename
 
+        # Imported here so Civitai and Replicate downloads skip its import cost
+        from huggingface_hub import hf_hub_download
+
         file_path = hf_hub_download(
             repo_id=repo_id,
             revision=revision,
             filename="/".join(filename_and_path),
-            local_dir=HF_TEMP_DIR,
+            cache_dir=HF_CACHE_DIR,
         )
 
-        os.makedirs(COMFYUI_LORA_DIR, exist_ok=True)
-        shutil.move(file_path, dest_path)
+        _ensure_dir(COMFYUI_LORA_DIR)
+        try:
+            os.link(os.path.realpath(file_path), dest_path)
+        except FileExistsError:
+            # Another worker linked the same LoRA first
+            pass
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # Cache and LoRA dir are on different filesystems
+            with open(file_path, "rb") as src, _atomic_write(dest_path) as dst:
+                shutil.copyfileobj(src, dst, length=1024 * 1024)
 
         print(f"Successfully downloaded {filename}")
         return filename
@@ -59,19 +175,32 @@ class DownloadExternalLora:
         filename = self.get_civitai_filename(url)
         dest_path = os.path.join(COMFYUI_LORA_DIR, filename)
 
-        if os.path.exists(dest_path):
+        if _exists(dest_path):
             print(f"File {filename} already exists. Skipping download.")
             return filename
 
         print(f"Downloading LoRA from Civitai: {url} to {filename}")
 
         start_time = time.time()
-        try:
-            result = subprocess.run(["pget", "-f", url, dest_path], timeout=600)
-            if result.returncode != 0:
-                raise RuntimeError("Download failed.")
-        except subprocess.TimeoutExpired:
-            raise RuntimeError("Download failed due to timeout")
+        _ensure_dir(COMFYUI_LORA_DIR)
+        if not self.download_in_ranges(url, dest_path):
+            fd, temp_path = tempfile.mkstemp(dir=COMFYUI_LORA_DIR, suffix=".tmp")
+            os.close(fd)
+            command = ["pget", "-f", url, temp_path]
+            if PGET_CONCURRENCY:
+                command[2:2] = ["--concurrency", PGET_CONCURRENCY]
+            try:
+                result = subprocess.run(command, timeout=600)
+                if result.returncode != 0:
+                    raise RuntimeError("Download failed.")
+                os.replace(temp_path, dest_path)
+            except subprocess.TimeoutExpired:
+                os.unlink(temp_path)
+                raise RuntimeError("Download failed due to timeout")
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.unlink(temp_path)
+                raise
 
         print(f"Successfully downloaded {filename}")
         end_time = time.time()
@@ -83,28 +212,138 @@ class DownloadExternalLora:
         print(f"Downloading LoRA from Replicate: {url}")
         filename = self.get_replicate_filename(url)
         dest_path = os.path.join(COMFYUI_LORA_DIR, filename)
-        temp_tar_path = os.path.join(HF_TEMP_DIR, filename)
 
-        if os.path.exists(dest_path):
+        if _exists(dest_path):
             print(f"File {filename} already exists. Skipping download.")
             return filename
 
-        subprocess.run(["pget", "-f", url, temp_tar_path], timeout=600)
+        # Stream the tar and extract the safetensors file as it arrives,
+        # rather than writing the whole archive to disk first. Members are
+        # read in order and the download stops once the LoRA is found, so
+        # archives with lora.safetensors first only fetch that one file.
+        deadline = time.time() + DOWNLOAD_TIMEOUT
+        with self.session.get(url, stream=True, timeout=600) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            with tarfile.open(fileobj=response.raw, mode="r|*") as tar:
+                lora_file = None
+                for member in tar:
+                    if member.name == REPLICATE_LORA_MEMBER:
+                        lora_file = tar.extractfile(member)
+                        break
+                    if time.time() > deadline:
+                        raise RuntimeError("Download failed due to timeout")
 
-        # Extract the safetensors file from the tar
-        with tarfile.open(temp_tar_path, "r") as tar:
-            lora_file = tar.extractfile("output/flux_train_replicate/lora.safetensors")
-            if lora_file is None:
-                raise ValueError("LoRA file not found in the downloaded tar")
+                if lora_file is None:
+                    raise ValueError("LoRA file not found in the downloaded tar")
 
-            os.makedirs(COMFYUI_LORA_DIR, exist_ok=True)
-            with open(dest_path, "wb") as f:
-                f.write(lora_file.read())
+                _ensure_dir(COMFYUI_LORA_DIR)
+                with _atomic_write(dest_path) as f:
+                    while chunk := lora_file.read(1024 * 1024):
+                        if time.time() > deadline:
+                            raise RuntimeError("Download failed due to timeout")
+                        f.write(chunk)
 
-        os.unlink(temp_tar_path)
         print(f"Successfully downloaded and extracted {filename}")
         return filename
 
+    def download_in_ranges(self, url: str, dest_path: str) -> bool:
+        # Probe with a one byte range rather than HEAD, as signed CDN
+        # redirect URLs are often only valid for GET
+        # Ask for identity encoding so byte counts match the requested ranges
+        headers = {"Range": "bytes=0-0", "Accept-Encoding": "identity"}
+        with self.session.get(
+            url, headers=headers, stream=True, timeout=30
+        ) as response:
+            response.raise_for_status()
+            total = response.headers.get("Content-Range", "").rpartition("/")[2]
+            if response.status_code != 206 or not total.isdigit() or total == "0":
+                return False
+            url = response.url
+
+        size = int(total)
+        chunk_size = -(-size // RANGE_CONNECTIONS)
+        ranges = [
+            (start, min(start + chunk_size, size) - 1)
+            for start in range(0, size, chunk_size)
+        ]
+
+        deadline = time.time() + DOWNLOAD_TIMEOUT
+        cancelled = threading.Event()
+        responses = []
+        # Ranges go to a temp file that is only moved into place once every
+        # range is complete, so an interrupted download never looks finished
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(dest_path), suffix=".tmp")
+        try:
+            os.ftruncate(fd, size)
+            with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                futures = [
+                    executor.submit(
+                        self.download_range,
+                        url,
+                        fd,
+                        start,
+                        end,
+                        deadline,
+                        cancelled,
+                        responses,
+                    )
+                    for start, end in ranges
+                ]
+                try:
+                    for future in as_completed(futures):
+                        future.result()
+                except BaseException:
+                    # Stop the other ranges now instead of waiting for them
+                    # to finish or time out
+                    cancelled.set()
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    for response in list(responses):
+                        _abort_response(response)
+                    raise
+        except BaseException:
+            os.close(fd)
+            os.unlink(temp_path)
+            raise
+
+        os.close(fd)
+        os.replace(temp_path, dest_path)
+        return True
+
+    def download_range(
+        self,
+        url: str,
+        fd: int,
+        start: int,
+        end: int,
+        deadline: float,
+        cancelled: threading.Event,
+        responses: list,
+    ):
+        headers = {"Range": f"bytes={start}-{end}", "Accept-Encoding": "identity"}
+        with self.session.get(
+            url, headers=headers, stream=True, timeout=600
+        ) as response:
+            responses.append(response)
+            if cancelled.is_set():
+                return
+
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise RuntimeError(f"Server ignored range request for {url}")
+
+            offset = start
+            for chunk in response.raw.stream(64 * 1024, decode_content=False):
+                if cancelled.is_set():
+                    return
+                if time.time() > deadline:
+                    raise RuntimeError("Download failed due to timeout")
+                os.pwrite(fd, chunk, offset)
+                offset += len(chunk)
+
+        if offset != end + 1:
+            raise RuntimeError(f"Incomplete download of bytes {start}-{end}")
+
     @staticmethod
     def get_replicate_filename(url: str) -> str:
         unique_id = url.split("/")[-2]
@@ -112,28 +351,35 @@ class DownloadExternalLora:
 
     @staticmethod
     def get_civitai_filename(url: str) -> str:
-        parsed_url = urllib.parse.urlparse(url)
-        query_params = urllib.parse.parse_qs(parsed_url.query)
-        model_id = parsed_url.path.split("/")[-1]
+        path, _, query = url.partition("#")[0].partition("?")
+        model_id = path.rsplit("/", 1)[-1]
+
+        # Match parse_qs: decoded values, blanks skipped, first value wins
+        query_params = {}
+        for param in query.split("&"):
+            key, _, value = param.partition("=")
+            if value:
+                query_params.setdefault(
+                    urllib.parse.unquote_plus(key), urllib.parse.unquote_plus(value)
+                )
 
         filename_parts = [f"civitai_{model_id}"]
         for param in ["type", "format", "size", "fp"]:
-            if value := query_params.get(param, [""])[0]:
+            if value := query_params.get(param):
                 filename_parts.append(value.lower())
 
         return "_".join(filename_parts) + ".safetensors"
 
     @staticmethod
     def extract_parts_from_huggingface_url(url: str):
-        parsed_url = urllib.parse.urlparse(url)
-        path_parts = parsed_url.path.split("/")
+        match = HF_URL_PATTERN.match(url.partition("#")[0].partition("?")[0])
 
-        if len(path_parts) < 5:
+        if match is None:
             raise ValueError(f"HuggingFace URL does not contain enough parts: {url}")
 
-        repo_id = f"{path_parts[1]}/{path_parts[2]}"
-        revision = path_parts[4]
-        filename_and_path = path_parts[5:]
+        repo_id = f"{match[1]}/{match[2]}"
+        revision = match[3]
+        filename_and_path = match[4].split("/")
         filename = filename_and_path[-1]
 
         return repo_id, revision, filename_and_path, filename
@@ -1,7 +1,8 @@
 import os
+import copy
 import mimetypes
-import json
 import shutil
+import orjson
 from typing import List
 from cog import BasePredictor, Input, Path
 from comfyui import ComfyUI
@@ -12,20 +13,37 @@ from download_external_lora import DownloadExternalLora
 OUTPUT_DIR = "/tmp/outputs"
 INPUT_DIR = "/tmp/inputs"
 COMFYUI_TEMP_OUTPUT_DIR = "ComfyUI/temp"
-HF_TEMP_DIR = "TEMP_HF"
-ALL_DIRECTORIES = [OUTPUT_DIR, INPUT_DIR, COMFYUI_TEMP_OUTPUT_DIR, HF_TEMP_DIR]
+ALL_DIRECTORIES = [OUTPUT_DIR, INPUT_DIR, COMFYUI_TEMP_OUTPUT_DIR]
 mimetypes.add_type("image/webp", ".webp")
 api_json_file = "workflow_api.json"
 os.environ["HF_HUB_DISABLE_TELEMETRY"] = "1"
 
+PREPROCESSOR_MAP = {
+    "Canny": "CannyEdgePreprocessor",
+    "Midas": "MiDaS-DepthMapPreprocessor",
+    "Zoe": "Zoe-DepthMapPreprocessor",
+    "DepthAnything": "DepthAnythingPreprocessor",
+    "Zoe-DepthAnything": "Zoe_DepthAnythingPreprocessor",
+    "HED": "HEDPreprocessor",
+    "TEED": "TEEDPreprocessor",
+    "PiDiNet": "PiDiNetPreprocessor",
+}
+
+CONTROL_WEIGHTS_MAP = {
+    "canny": "flux-canny-controlnet-v3.safetensors",
+    "soft_edge": "flux-hed-controlnet-v3.safetensors",
+    "depth": "flux-depth-controlnet-v3.safetensors",
+}
+
 
 class Predictor(BasePredictor):
     def setup(self):
         self.comfyUI = ComfyUI("127.0.0.1:8188")
         self.comfyUI.start_server(OUTPUT_DIR, INPUT_DIR)
+        self.lora_downloader = DownloadExternalLora()
 
-        with open(api_json_file, "r") as file:
-            workflow = json.loads(file.read())
+        with open(api_json_file, "rb") as file:
+            workflow = orjson.loads(file.read())
         self.comfyUI.handle_weights(
             workflow,
             weights_to_download=[
@@ -41,6 +59,7 @@ class Predictor(BasePredictor):
                 "table5_pidinet.pth",
             ],
         )
+        self.workflow_template = workflow
 
     def filename_with_extension(self, input_file, prefix):
         extension = os.path.splitext(input_file.name)[1]
@@ -51,43 +70,31 @@ class Predictor(BasePredictor):
         input_file: Path,
         filename: str = "image.png",
     ):
-        shutil.copy(input_file, os.path.join(INPUT_DIR, filename))
-
-    def preprocessor_map(self, preprocessor_label):
-        return {
-            "Canny": "CannyEdgePreprocessor",
-            "Midas": "MiDaS-DepthMapPreprocessor",
-            "Zoe": "Zoe-DepthMapPreprocessor",
-            "DepthAnything": "DepthAnythingPreprocessor",
-            "Zoe-DepthAnything": "Zoe_DepthAnythingPreprocessor",
-            "HED": "HEDPreprocessor",
-            "TEED": "TEEDPreprocessor",
-            "PiDiNet": "PiDiNetPreprocessor",
-        }[preprocessor_label]
-
-    def control_weights_map(self, control_type):
-        return {
-            "canny": "flux-canny-controlnet-v3.safetensors",
-            "soft_edge": "flux-hed-controlnet-v3.safetensors",
-            "depth": "flux-depth-controlnet-v3.safetensors",
-        }[control_type]
+        # ComfyUI only reads the input, so link to it rather than copying
+        dest = os.path.join(INPUT_DIR, filename)
+        if os.path.lexists(dest):
+            os.unlink(dest)
+        try:
+            os.symlink(os.path.abspath(input_file), dest)
+        except OSError:
+            shutil.copy(input_file, dest)
 
     def download_lora(self, lora):
         print(f"Downloading LoRA from {lora}")
-        downloader = DownloadExternalLora()
-        lora_file_name = downloader.download(lora)
+        lora_file_name = self.lora_downloader.download(lora)
         return lora_file_name
 
     def update_workflow(self, workflow, **kwargs):
+        prompt = kwargs["prompt"]
+        negative = f"nsfw, {kwargs['negative_prompt']}"
+        guidance_scale = kwargs["guidance_scale"]
+        seed = kwargs["seed"]
+
         positive_prompt = workflow["53"]["inputs"]
-        positive_prompt["clip_l"] = kwargs["prompt"]
-        positive_prompt["t5xxl"] = kwargs["prompt"]
-        positive_prompt["guidance"] = kwargs["guidance_scale"]
+        positive_prompt.update(clip_l=prompt, t5xxl=prompt, guidance=guidance_scale)
 
         negative_prompt = workflow["57"]["inputs"]
-        negative_prompt["clip_l"] = f"nsfw, {kwargs['negative_prompt']}"
-        negative_prompt["t5xxl"] = f"nsfw, {kwargs['negative_prompt']}"
-        negative_prompt["guidance"] = kwargs["guidance_scale"]
+        negative_prompt.update(clip_l=negative, t5xxl=negative, guidance=guidance_scale)
 
         control_image = workflow["16"]["inputs"]
         control_image["image"] = kwargs["control_image_filename"]
@@ -96,16 +103,18 @@ class Predictor(BasePredictor):
         control_strength["strength"] = kwargs["control_strength"]
 
         sampler = workflow["3"]["inputs"]
-        sampler["steps"] = kwargs["steps"]
-        sampler["noise_seed"] = kwargs["seed"]
-        sampler["seed"] = kwargs["seed"]
-        sampler["true_gs"] = kwargs["guidance_scale"]
-        sampler["image_to_image_strength"] = kwargs["image_to_image_strength"]
+        sampler.update(
+            steps=kwargs["steps"],
+            noise_seed=seed,
+            seed=seed,
+            true_gs=guidance_scale,
+            image_to_image_strength=kwargs["image_to_image_strength"],
+        )
 
         control_weights = workflow["13"]["inputs"]
-        control_weights["controlnet_path"] = self.control_weights_map(
+        control_weights["controlnet_path"] = CONTROL_WEIGHTS_MAP[
             kwargs["control_type"]
-        )
+        ]
 
         if kwargs["control_type"] == "depth":
             preprop = kwargs["depth_preprocessor"]
@@ -115,7 +124,7 @@ class Predictor(BasePredictor):
             preprop = "Canny"
 
         preprocessor = workflow["51"]["inputs"]
-        preprocessor["preprocessor"] = self.preprocessor_map(preprop)
+        preprocessor["preprocessor"] = PREPROCESSOR_MAP[preprop]
 
         using_lora = kwargs["lora_filename"] is not None
         if using_lora:
@@ -210,8 +219,7 @@ class Predictor(BasePredictor):
         if lora_url:
             lora_filename = self.download_lora(lora_url)
 
-        with open(api_json_file, "r") as file:
-            workflow = json.loads(file.read())
+        workflow = copy.deepcopy(self.workflow_template)
 
         self.update_workflow(
             workflow,